@@ -1,8 +1,9 @@
 import streamlit as st
 import os
+from contextlib import ExitStack
 from dotenv import load_dotenv
 import tempfile
-import io
+import shutil
 import utils
 
 # Load environment variables
@@ -32,11 +33,8 @@ with tab1:
     if input_type == "Upload File":
         uploaded_file = st.file_uploader("Choose a media file", type=["mp3", "mp4", "wav", "m4a", "mpeg", "mpga", "webm"], key="media_uploader")
         if uploaded_file is not None:
-            # Save uploaded file to temp file
-            suffix = os.path.splitext(uploaded_file.name)[1]
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                media_source = tmp_file.name
+            # Written to a temp file only when processed, so reruns don't leave copies behind
+            media_source = uploaded_file
     else:
         url_input = st.text_input("Enter Media URL (e.g., YouTube URL):")
         if url_input:
@@ -54,29 +52,41 @@ with tab1:
 
     if media_source:
         if st.button("Process Media", key="process_btn"):
-            with st.spinner("Processing with Gemini..."):
+            with st.spinner("Processing with Gemini..."), ExitStack() as temp_files:
                 try:
-                    # If it's a URL, we might need to download it if Gemini doesn't support it directly
-                    # The template suggested YOUTUBE_URL can be used directly, but usually it requires local file.
-                    # Let's try to download it if it's a URL to be safe, or just pass it if Gemini 2.x handles it.
-                    # Actually, let's use the local file approach to ensure it works.
-                    
                     if is_url:
                         # Process URL directly
                         results = utils.process_media_with_gemini(media_source, client, is_url=True)
                     else:
-                        # Process uploaded file
-                        results = utils.process_media_with_gemini(media_source, client, is_url=False)
+                        # Process uploaded file, reusing the Gemini upload if this file was already sent
+                        cached_upload = st.session_state.get('gemini_file')
+                        file_upload = None
+                        if cached_upload and cached_upload[0] == uploaded_file.file_id:
+                            # Gemini deletes uploads after 48 h, so confirm it still has this one
+                            file_upload = utils.get_active_file(cached_upload[1].name, client)
+                        if file_upload is None:
+                            # Save uploaded file to temp file, registering its cleanup as soon as it exists
+                            suffix = os.path.splitext(uploaded_file.name)[1]
+                            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+                                temp_files.callback(utils.remove_file, tmp_file.name)
+                                uploaded_file.seek(0)
+                                shutil.copyfileobj(uploaded_file, tmp_file, 1024 * 1024)
+
+                            # Extract/compress audio only when needed
+                            audio_path = utils.prepare_audio(tmp_file.name)
+                            if audio_path != tmp_file.name:
+                                temp_files.callback(utils.remove_file, audio_path)
+                            file_upload = utils.upload_media(audio_path, client)
+                            st.session_state['gemini_file'] = (uploaded_file.file_id, file_upload)
+                        results = utils.transcribe_uploaded_file(file_upload, client)
                     
                     st.success("Processing Complete!")
                     st.session_state['gemini_results'] = results
                     
                 except Exception as e:
+                    # Don't keep reusing an upload that may be what failed
+                    st.session_state.pop('gemini_file', None)
                     st.error(f"An error occurred: {e}")
-                finally:
-                    # Clean up uploaded temp file
-                    if not is_url and media_source and os.path.exists(media_source):
-                        os.remove(media_source)
 
     if 'gemini_results' in st.session_state:
         results = st.session_state['gemini_results']
@@ -99,33 +109,37 @@ with tab1:
 
         st.subheader("Transcript")
         
-        full_transcript_text = ""
-        segments = results_dict.get('segments', [])
-        
+        # Rendering thousands of segments is wasted work on reruns that don't change the results or display options
+        render_options = (show_simple, show_timestamps, show_diarization)
+        cached_render = st.session_state.get('_transcript_render')
+        if cached_render is None or cached_render[0] is not results or cached_render[1] != render_options:
+            segments = results_dict.get('segments', [])
+
+            def seg_field(seg, name, default):
+                # Handle both dict and object
+                return seg.get(name, default) if isinstance(seg, dict) else getattr(seg, name, default)
+
+            if show_simple:
+                transcript_display = " ".join(seg_field(seg, 'content', '') for seg in segments)
+                full_transcript_text = transcript_display
+            else:
+                timestamp_fmt = "[{}] " if show_timestamps else ""
+                speaker_fmt = "**{}**: " if show_diarization else ""
+                lines = [
+                    timestamp_fmt.format(seg_field(seg, 'timestamp', '--:--'))
+                    + speaker_fmt.format(seg_field(seg, 'speaker', 'Unknown'))
+                    + seg_field(seg, 'content', '')
+                    for seg in segments
+                ]
+                transcript_display = "\n\n".join(lines)
+                full_transcript_text = "\n".join(lines)
+            st.session_state['_transcript_render'] = (results, render_options, transcript_display, full_transcript_text)
+        _, _, transcript_display, full_transcript_text = st.session_state['_transcript_render']
+
         if show_simple:
-            simple_text = " ".join([seg.get('content', '') if isinstance(seg, dict) else getattr(seg, 'content', '') for seg in segments])
-            st.text_area("Simple Transcript", simple_text, height=300)
-            full_transcript_text = simple_text
+            st.text_area("Simple Transcript", transcript_display, height=300)
         else:
-            formatted_segments = []
-            for seg in segments:
-                # Handle both dict and object
-                s_speaker = seg.get('speaker', 'Unknown') if isinstance(seg, dict) else getattr(seg, 'speaker', 'Unknown')
-                s_timestamp = seg.get('timestamp', '--:--') if isinstance(seg, dict) else getattr(seg, 'timestamp', '--:--')
-                s_content = seg.get('content', '') if isinstance(seg, dict) else getattr(seg, 'content', '')
-                
-                line = ""
-                if show_timestamps:
-                    line += f"[{s_timestamp}] "
-                if show_diarization:
-                    line += f"**{s_speaker}**: "
-                
-                line += s_content
-                formatted_segments.append(line)
-            
-            transcript_display = "\n\n".join(formatted_segments)
             st.markdown(transcript_display)
-            full_transcript_text = "\n".join(formatted_segments)
 
         st.download_button(
             label="Download Transcript",
@@ -140,10 +154,15 @@ with tab1:
 with tab2:
     st.write("Upload a text file to summarize it using Gemini.")
     uploaded_text_file = st.file_uploader("Choose a text file", type=["txt"], key="text_uploader")
+    # Keeps the content in a Gemini context cache so repeated summaries/questions don't resend it
+    cache_context = st.checkbox("Cache content for faster follow-up questions", value=False, key="cache_context")
     
     if uploaded_text_file is not None:
-        stringio = io.StringIO(uploaded_text_file.getvalue().decode("utf-8"))
-        file_text = stringio.read()
+        # Decode once per uploaded file rather than on every widget interaction
+        if st.session_state.get('_txt_fid') != uploaded_text_file.file_id:
+            st.session_state['_txt'] = uploaded_text_file.getvalue().decode("utf-8")
+            st.session_state['_txt_fid'] = uploaded_text_file.file_id
+        file_text = st.session_state['_txt']
         
         st.text_area("File Content", file_text, height=200)
         
@@ -155,14 +174,17 @@ with tab2:
             
         if st.button("Generate Summary & Key Ideas", key="sum_txt_btn"):
             with st.spinner("Processing..."):
-                summary_txt = utils.summarize_text(file_text, num_words_txt, client)
-                key_ideas_txt = utils.extract_key_ideas(file_text, num_ideas_txt, client)
-                
-                st.subheader("Summary")
-                st.write(summary_txt)
-                
-                st.subheader("Key Ideas")
-                st.write(key_ideas_txt)
+                try:
+                    cache_handle = utils.get_context_cache(file_text, client) if cache_context else None
+                    summary_txt, key_ideas_txt = utils.summarize_and_extract(file_text, num_words_txt, num_ideas_txt, client, cache_handle=cache_handle)
+                    
+                    st.subheader("Summary")
+                    st.write(summary_txt)
+                    
+                    st.subheader("Key Ideas")
+                    st.markdown("\n".join(f"- {idea}" for idea in key_ideas_txt))
+                except Exception as e:
+                    st.error(f"An error occurred: {e}")
 
     if 'transcript_text' in st.session_state or ('file_text' in locals() and file_text):
         st.markdown("---")
@@ -177,8 +199,12 @@ with tab2:
         if st.button("Ask Question", key="ask_btn"):
              if text_question:
                  with st.spinner("Thinking..."):
-                     answer = utils.ask_question(context_text, text_question, client)
-                     st.subheader("Answer")
-                     st.write(answer)
+                     try:
+                         cache_handle = utils.get_context_cache(context_text, client) if cache_context else None
+                         answer = utils.ask_question(context_text, text_question, client, cache_handle=cache_handle)
+                         st.subheader("Answer")
+                         st.write(answer)
+                     except Exception as e:
+                         st.error(f"An error occurred: {e}")
              else:
                  st.warning("Please enter a question.")
@@ -1,8 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
 from google import genai
+from google.genai import errors
 from google.genai import types
+import numpy as np
 import os
+import re
+import shutil
 import streamlit as st
+import subprocess
 import tempfile
+import textwrap
+import time
+from urllib.parse import urlparse
 import yt_dlp
 
 def get_api_key():
@@ -18,22 +32,25 @@ def get_api_key():
     else:
         return None
 
+@st.cache_resource
+def _create_gemini_client(api_key):
+    """Creates the Gemini client once per API key so its connection pool survives reruns."""
+    return genai.Client(api_key=api_key)
+
 def get_gemini_client():
     """Initializes and returns the Gemini client."""
     api_key = get_api_key()
     if not api_key:
         return None
-    return genai.Client(api_key=api_key)
+    return _create_gemini_client(api_key)
 
-def download_youtube_audio(url):
-    """Downloads audio from YouTube URL and returns the path to the temp file."""
+def download_youtube_audio(url, output_dir):
+    """Downloads audio from YouTube URL into output_dir and returns the path to the downloaded file."""
     ydl_opts = {
-        'format': 'm4a/bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'm4a',
-        }],
-        'outtmpl': os.path.join(tempfile.gettempdir(), '%(id)s.%(ext)s'),
+        # Write the source audio container as-is instead of re-encoding it with a postprocessor
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'postprocessors': [],
+        'outtmpl': os.path.join(output_dir, '%(id)s.%(ext)s'),
         'quiet': True,
         'no_warnings': True,
     }
@@ -41,11 +58,125 @@ def download_youtube_audio(url):
         info = ydl.extract_info(url, download=True)
         return ydl.prepare_filename(info)
 
+def remove_file(path):
+    """Deletes a temp file, ignoring one that was already removed."""
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+# Audio containers that can be uploaded as-is; anything else (e.g. mp4 video) gets its audio extracted.
+AUDIO_PASSTHROUGH_SUFFIXES = (".mp3", ".m4a", ".mpga", ".webm", ".wav")
+MAX_PASSTHROUGH_BYTES = 24 * 1024 * 1024
+
+def prepare_audio(file_path):
+    """
+    Returns a path to audio suitable for upload. Small files already in an audio container are
+    returned unchanged; otherwise the audio is extracted/compressed with ffmpeg into a new temp file.
+    """
+    suffix = os.path.splitext(file_path)[1].lower()
+    if suffix in AUDIO_PASSTHROUGH_SUFFIXES and os.path.getsize(file_path) < MAX_PASSTHROUGH_BYTES:
+        return file_path
+
+    # Speech models work on 16 kHz mono anyway, so 32 kbps Opus keeps the upload small without losing anything
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as tmp_ogg:
+        output_path = tmp_ogg.name
+    try:
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", file_path,
+             "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "32k", output_path],
+            check=True,
+        )
+    except Exception:
+        remove_file(output_path)
+        raise
+    return output_path
+
+def is_youtube_url(url):
+    """Returns True if url points at YouTube, which Gemini can read directly via file_uri."""
+    host = (urlparse(url).hostname or "").lower()
+    return host in ("youtube.com", "youtu.be") or host.endswith(".youtube.com")
+
+def _is_unreadable_url_error(error):
+    """
+    Returns True if Gemini rejected a file_uri-only request as an invalid argument. Its wording for
+    unreadable URLs is often generic, so this goes by status; an invalid API key is also reported as
+    INVALID_ARGUMENT and is excluded. Auth, permission and quota errors carry other statuses.
+    """
+    if error.code != 400 or error.status != "INVALID_ARGUMENT":
+        return False
+    return "API_KEY_INVALID" not in str(error.details) and "api key" not in (error.message or "").lower()
+
 def process_media_with_gemini(media_source, client, is_url=False):
     """
     Processes media (local file path or URL) using Gemini and returns structured JSON.
     """
-    prompt = """
+    if is_url:
+        if is_youtube_url(media_source):
+            try:
+                # Let Gemini fetch the video itself, skipping the download and upload entirely
+                return _transcribe_file_part(
+                    types.Part(file_data=types.FileData(file_uri=media_source)), client
+                )
+            except errors.ClientError as e:
+                if not _is_unreadable_url_error(e):
+                    raise # e.g. a bad API key or exhausted quota, which downloading would not fix
+                # Gemini could not read the URL directly, fall back to downloading it
+
+        # A directory per call, so concurrent sessions fetching the same video never share a file
+        download_dir = tempfile.mkdtemp()
+        try:
+            download_path = download_youtube_audio(media_source, download_dir)
+            # The /best fallback can fetch a full video, so extract/compress audio as for uploads
+            audio_path = prepare_audio(download_path)
+            try:
+                return process_media_with_gemini(audio_path, client, is_url=False)
+            finally:
+                if audio_path != download_path:
+                    remove_file(audio_path)
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+    # For local file, we must upload it to Gemini's file service first
+    file_upload = upload_media(media_source, client)
+    return transcribe_uploaded_file(file_upload, client)
+
+def upload_media(file_path, client, timeout=600):
+    """
+    Uploads a local file to Gemini's file service and returns the File once it is ready to use,
+    polling its processing state with exponential backoff.
+    """
+    file_upload = client.files.upload(file=file_path)
+    delay = 1
+    deadline = time.monotonic() + timeout
+    while file_upload.state == types.FileState.PROCESSING:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini is still processing {file_upload.name} after {timeout}s.")
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+        file_upload = client.files.get(name=file_upload.name)
+    if file_upload.state == types.FileState.FAILED:
+        raise RuntimeError(f"Gemini could not process the uploaded file {file_upload.name}.")
+    return file_upload
+
+def get_active_file(name, client):
+    """Returns the uploaded File called name if Gemini still has it ready to use, otherwise None."""
+    try:
+        file_upload = client.files.get(name=name)
+    except errors.ClientError:
+        return None # Expired or deleted
+    return file_upload if file_upload.state == types.FileState.ACTIVE else None
+
+def transcribe_uploaded_file(file_upload, client):
+    """Transcribes a File previously returned by upload_media and returns structured JSON."""
+    file_part = types.Part(
+        file_data=types.FileData(
+            file_uri=file_upload.uri,
+            mime_type=file_upload.mime_type
+        )
+    )
+    return _transcribe_file_part(file_part, client)
+
+# The transcription prompt, schema and config never change, so they are built once at import time
+_TRANSCRIPT_PROMPT = """
     Process the audio file and generate a detailed transcription.
 
     Requirements:
@@ -55,89 +186,354 @@ def process_media_with_gemini(media_source, client, is_url=False):
     4. If the segment is in a language different than English, also provide the English translation.
     """
 
-    if is_url:
-        # Use URL directly via file_uri as in user template
-        file_part = types.Part(
-            file_data=types.FileData(
-                file_uri=media_source
-            )
-        )
-    else:
-        # For local file, we must upload it to Gemini's file service first
-        file_upload = client.files.upload(file=media_source)
-        file_part = types.Part(
-            file_data=types.FileData(
-                file_uri=file_upload.uri,
-                mime_type=file_upload.mime_type
-            )
-        )
+_TRANSCRIPT_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "summary": types.Schema(
+            type=types.Type.STRING,
+            description="A concise summary of the audio content.",
+        ),
+        "segments": types.Schema(
+            type=types.Type.ARRAY,
+            description="List of transcribed segments with speaker and timestamp.",
+            items=types.Schema(
+                type=types.Type.OBJECT,
+                properties={
+                    "speaker": types.Schema(type=types.Type.STRING),
+                    "timestamp": types.Schema(type=types.Type.STRING),
+                    "content": types.Schema(type=types.Type.STRING),
+                    "language": types.Schema(type=types.Type.STRING),
+                    "language_code": types.Schema(type=types.Type.STRING),
+                    "translation": types.Schema(type=types.Type.STRING),
+                },
+                required=["speaker", "timestamp", "content", "language", "language_code"],
+            ),
+        ),
+    },
+    required=["summary", "segments"],
+)
+
+_TRANSCRIPT_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=_TRANSCRIPT_SCHEMA,
+)
 
+def _transcribe_file_part(file_part, client):
+    """Transcribes an uploaded or remote media part with Gemini and returns structured JSON."""
     response = client.models.generate_content(
         model="gemini-2.0-flash", # Matching template model but note 2.5 flash might be internal/future
         contents=[
             types.Content(
                 parts=[
                     file_part,
-                    types.Part(text=prompt)
+                    types.Part(text=_TRANSCRIPT_PROMPT)
                 ]
             )
         ],
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=types.Schema(
-                type=types.Type.OBJECT,
-                properties={
-                    "summary": types.Schema(
-                        type=types.Type.STRING,
-                        description="A concise summary of the audio content.",
-                    ),
-                    "segments": types.Schema(
-                        type=types.Type.ARRAY,
-                        description="List of transcribed segments with speaker and timestamp.",
-                        items=types.Schema(
-                            type=types.Type.OBJECT,
-                            properties={
-                                "speaker": types.Schema(type=types.Type.STRING),
-                                "timestamp": types.Schema(type=types.Type.STRING),
-                                "content": types.Schema(type=types.Type.STRING),
-                                "language": types.Schema(type=types.Type.STRING),
-                                "language_code": types.Schema(type=types.Type.STRING),
-                                "translation": types.Schema(type=types.Type.STRING),
-                            },
-                            required=["speaker", "timestamp", "content", "language", "language_code"],
-                        ),
-                    ),
-                },
-                required=["summary", "segments"],
-            ),
-        ),
+        config=_TRANSCRIPT_CONFIG,
     )
     
     return response.parsed
 
-def summarize_text(text, num_words, client):
-    """Summarizes text using Gemini."""
-    prompt = f"Please summarize the following text in approximately {num_words} words:\n\n{text}"
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[prompt]
+EMBEDDING_MODEL = "text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+# Words capitalized only because they start a question, so they say nothing about what is asked
+_QUESTION_OPENERS = frozenset((
+    "what", "who", "whom", "whose", "which", "when", "where", "why", "how", "can", "could", "would",
+    "should", "will", "did", "do", "does", "is", "are", "was", "were", "has", "have", "had", "please",
+    "tell", "list", "give", "summarize", "explain", "describe", "in", "on", "according", "the", "a", "an",
+    "and", "so", "i", "any",
+))
+
+def _query_terms(text):
+    """
+    Returns the numbers and capitalized words (names, speakers, products) in text. A leading
+    question or stop word is skipped, but a leading name is kept. Two queries that differ in these
+    ask about different things, however similar they read.
+    """
+    words = re.findall(r"[\w'-]+", text)
+    if words and words[0].lower() in _QUESTION_OPENERS:
+        words = words[1:]
+    return frozenset(word.lower() for word in words if word[0].isdigit() or word[0].isupper())
+
+def _digest(*parts):
+    """Returns a short blake2b hex digest over the string form of parts."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+# Gemini accepts at most this many texts per batched embedding request
+EMBEDDING_BATCH_SIZE = 100
+# Upper bound on batched embedding requests in flight at once for a single call
+EMBEDDING_MAX_WORKERS = 4
+
+def embed_texts(texts, client):
+    """
+    Embeds a list of texts with Gemini and returns them as L2-normalized rows of a 2D array.
+    Texts are sent in as few batched requests as possible, a few at a time when there are several.
+    """
+    def _embed_batch(batch):
+        return client.models.embed_content(model=EMBEDDING_MODEL, contents=batch)
+
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    if len(batches) == 1:
+        responses = [_embed_batch(batches[0])]
+    else:
+        # The sync client is safe to share across threads, unlike client.aio across event loops;
+        # map keeps the responses in input order
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_WORKERS, len(batches))) as executor:
+            responses = list(executor.map(_embed_batch, batches))
+
+    vectors = np.array(
+        [embedding.values for response in responses for embedding in response.embeddings], dtype=np.float32
     )
-    return response.text
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
 
-def extract_key_ideas(text, num_ideas, client):
-    """Extracts key ideas using Gemini."""
-    prompt = f"Please extract the top {num_ideas} key ideas from the following text as a bulleted list:\n\n{text}"
-    response = client.models.generate_content(
+def embed_query(text, client):
+    """Embeds a single text, reusing earlier embeddings of the same text from st.session_state."""
+    cache = st.session_state.setdefault("_query_emb", {})
+    key = _digest(text)
+    if key not in cache:
+        cache[key] = embed_texts([text], client)[0]
+    return cache[key]
+
+def semantic_cache(task, query_arg=None):
+    """
+    Caches a function's results in st.session_state["_sem_cache"].
+
+    Exact hits are keyed on a hash of every argument except the client and cache handle. If
+    query_arg is given, a miss also compares the embedding of that argument against earlier
+    queries made with the same remaining arguments, and reuses the stored answer when the
+    similarity is high enough and both queries name the same entities and numbers.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            client = params.pop("client")
+            params.pop("cache_handle", None) # Derived from the text, so it adds nothing to the key
+            query = params.pop(query_arg) if query_arg else ""
+
+            cache = st.session_state.setdefault("_sem_cache", {})
+            bucket = cache.setdefault(
+                _digest(task, *params.values()), {"exact": {}, "vectors": [], "terms": [], "answers": []}
+            )
+            exact_key = _digest(query)
+            if exact_key in bucket["exact"]:
+                return bucket["exact"][exact_key]
+
+            query_vector = None
+            if query_arg:
+                try:
+                    query_vector = embed_query(query, client)
+                except Exception:
+                    pass # Embedding failed, fall back to exact-hit caching only
+            query_terms = _query_terms(query)
+            if query_vector is not None and bucket["vectors"]:
+                scores = np.vstack(bucket["vectors"]) @ query_vector
+                # Only paraphrases of the same question count, e.g. not "Speaker 1" vs "Speaker 2"
+                for i in np.argsort(-scores):
+                    if scores[i] <= SEMANTIC_CACHE_THRESHOLD:
+                        break
+                    if bucket["terms"][i] == query_terms:
+                        return bucket["answers"][i]
+
+            result = func(*args, **kwargs)
+            bucket["exact"][exact_key] = result
+            if query_vector is not None:
+                bucket["vectors"].append(query_vector)
+                bucket["terms"].append(query_terms)
+                bucket["answers"].append(result)
+            return result
+
+        return wrapper
+    return decorator
+
+# Explicit context caching needs a pinned model version, and cached content can only be used with that model.
+CACHE_MODEL = "gemini-2.0-flash-001"
+CONTEXT_CACHE_TTL_SECONDS = 3600
+# Recreate a cache this long before it expires, so a request never races its expiry
+CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS = 60
+
+def _is_cache_too_small_error(error):
+    """Returns True if Gemini refused to create a cache because the text is below the minimum size."""
+    message = (error.message or "").lower()
+    return error.code == 400 and ("too small" in message or "min_total_token_count" in message)
+
+def _is_missing_cache_error(error):
+    """
+    Returns True if a request failed because its cached content has expired or been deleted.
+    Gemini reports this as "CachedContent not found (or permission denied)", under 403 or 404.
+    """
+    return "cachedcontent" in (error.message or "").lower()
+
+def _drop_context_cache(cache_handle):
+    """Forgets a context cache that Gemini no longer has, so the next request creates a fresh one."""
+    caches = st.session_state.get("_context_caches", {})
+    for key in [key for key, entry in caches.items() if entry and entry[0] == cache_handle]:
+        del caches[key]
+
+def get_context_cache(text, client, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS):
+    """
+    Returns the name of a Gemini context cache holding text, or None if the text is sent inline.
+
+    The cache is tracked in st.session_state with its expiry time and recreated once it has expired.
+    Only one cache is kept per session: creating one for new text deletes the previous one.
+    Text that is too small to cache is remembered as such; other failures are retried on the next call.
+    """
+    caches = st.session_state.setdefault("_context_caches", {})
+    key = _digest(text)
+    if key in caches:
+        entry = caches[key]
+        if entry is None:
+            return None
+        name, expires_at = entry
+        if time.time() < expires_at - CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS:
+            return name
+
+    for entry in caches.values():
+        if entry:
+            try:
+                client.caches.delete(name=entry[0])
+            except Exception:
+                pass # Already expired or deleted on the Gemini side
+    caches.clear()
+
+    expires_at = time.time() + ttl_seconds
+    try:
+        cache = client.caches.create(
+            model=CACHE_MODEL,
+            config=types.CreateCachedContentConfig(
+                contents=[types.Content(role="user", parts=[types.Part(text=text)])],
+                ttl=f"{ttl_seconds}s",
+            ),
+        )
+    except errors.ClientError as e:
+        if _is_cache_too_small_error(e):
+            caches[key] = None
+        return None
+    except Exception:
+        return None # Transient failure, send the text inline this time
+    caches[key] = (cache.name, expires_at)
+    return cache.name
+
+def _generate(client, prompt, text, cache_handle=None, **config_kwargs):
+    """
+    Calls Gemini with prompt about text. With a cache_handle the text is read from the context
+    cache; if that cache has expired or is gone, the entry is dropped and the text is sent inline.
+    """
+    if cache_handle:
+        try:
+            return client.models.generate_content(
+                model=CACHE_MODEL,
+                contents=[prompt],
+                config=types.GenerateContentConfig(cached_content=cache_handle, **config_kwargs),
+            )
+        except errors.ClientError as e:
+            if not _is_missing_cache_error(e):
+                raise
+            _drop_context_cache(cache_handle)
+
+    # Same layout as the cached request: the text first, then the instruction about it
+    return client.models.generate_content(
         model="gemini-2.0-flash",
-        contents=[prompt]
+        contents=[text, prompt],
+        config=types.GenerateContentConfig(**config_kwargs) if config_kwargs else None,
     )
-    return response.text
 
-def ask_question(context_text, question, client):
-    """Asks a question about the context text using Gemini."""
-    prompt = f"You are a helpful assistant. Answer the user's question based strictly on the provided context text. Be concise, clear, and direct.\n\nContext:\n{context_text}\n\nQuestion: {question}"
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[prompt]
+_SUMMARY_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "summary": types.Schema(type=types.Type.STRING),
+        "key_ideas": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(type=types.Type.STRING),
+        ),
+    },
+    required=["summary", "key_ideas"],
+)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def summarize_and_extract(text, num_words, num_ideas, _client, cache_handle=None):
+    """Summarizes text and extracts key ideas in a single Gemini call, returning (summary, key_ideas)."""
+    prompt = f"""
+    Process the provided text.
+
+    Requirements:
+    1. Summarize it in approximately {num_words} words.
+    2. Extract the top {num_ideas} key ideas.
+    """
+    response = _generate(
+        _client,
+        prompt,
+        text,
+        cache_handle,
+        response_mime_type="application/json",
+        response_schema=_SUMMARY_SCHEMA,
     )
+    parsed = response.parsed
+    if parsed is None:
+        # The SDK leaves parsed empty when the JSON is truncated or the output was blocked
+        try:
+            parsed = json.loads(response.text or "")
+        except json.JSONDecodeError:
+            raise ValueError("Gemini did not return a usable summary. Please try again.") from None
+    return parsed["summary"], parsed["key_ideas"]
+
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_PASSAGE_CHARS = 500
+
+def split_passages(text, max_chars=RETRIEVAL_PASSAGE_CHARS):
+    """Splits text into passages of roughly max_chars, keeping transcript lines together where they fit."""
+    passages = []
+    current = ""
+    for line in text.splitlines():
+        for piece in textwrap.wrap(line, max_chars):
+            if current and len(current) + len(piece) + 1 > max_chars:
+                passages.append(current)
+                current = piece
+            else:
+                current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+def retrieve_context(context_text, question, client, k=RETRIEVAL_TOP_K):
+    """
+    Returns the k passages of context_text most similar to question, in document order.
+    Passage embeddings are computed once per context and kept in st.session_state['_emb'].
+    """
+    key = _digest(context_text)
+    index = st.session_state.get('_emb')
+    if index is None or index[0] != key:
+        passages = split_passages(context_text)
+        # Short contexts are sent whole, there is nothing to gain from retrieval
+        vectors = embed_texts(passages, client) if len(passages) > k else None
+        index = (key, passages, vectors)
+        st.session_state['_emb'] = index
+
+    _, passages, vectors = index
+    if vectors is None:
+        return context_text
+    scores = vectors @ embed_query(question, client)
+    top = np.sort(np.argpartition(-scores, k)[:k])
+    return "\n\n".join(passages[i] for i in top)
+
+@semantic_cache(task="ask_question", query_arg="question")
+def ask_question(context_text, question, client, cache_handle=None):
+    """Asks a question about the context text using Gemini."""
+    prompt = f"You are a helpful assistant. Answer the user's question based strictly on the provided context text. Be concise, clear, and direct.\n\nQuestion: {question}"
+    if not cache_handle:
+        try:
+            context_text = retrieve_context(context_text, question, client)
+        except Exception:
+            pass # Embedding failed, send the full context instead
+    response = _generate(client, prompt, context_text, cache_handle)
     return response.text